@@ -9,7 +9,8 @@ We use MATLAB ANT_interface codes to import raw .cnt data from ANT eego
 mylab EEG system into an EEGLAB .set file. Then we use the utility
 functions in this .py file to create MNE _raw.fif file of the recording.
 Subsequent processing can take place in python directly on the _raw.fif
-file.
+file. An existing _raw.fif file is only reused when overwrite=False is
+passed; overwrite=None rebuilds the recording in memory without saving.
 
 2)
 In the process of creating the _raw.fif file, we need a digitization of
@@ -19,8 +20,7 @@ a _raw.fif file
 
 
     # UPDATE: MNE v0.19+ uses a different set of API, this library has been adjusted to accommodate
-    the newest version of MNE for the new API. It should be back-compatible for versions before
-    v0.19 such as v0.18.2, but I haven't tested this library for back-compatibility.
+    the newest version of MNE for the new API. Versions before v0.19 are no longer supported.
 
 https://mne.tools/stable/auto_tutorials/intro/plot_40_sensor_locations.html#sphx-glr-auto-tutorials-intro-plot-40-sensor-locations-py
 
@@ -28,65 +28,20 @@ https://mne.tools/stable/auto_tutorials/intro/plot_40_sensor_locations.html#sphx
 Last update:
 Alex He -  03/26/2022
 """
-
-
-def ant_mne_dig2mont(montage, digmontage, kind='duke129_dig'):
-    """
-    This function is used to convert the information from a
-    DigMontage object to a Montage object. It handles some
-    peculiarities of how the channels are ordered. This is
-    necessary because mne.io.read_raw_eeglab only accepts
-    Montage but not DigMontage as input.
-
-    # UPDATE: MNE v0.19+ uses a different set of APIs, this function is only called by MNE versions prior to v0.19
-
-    :param montage: a MNE Montage object created from loading
-                    a template montage (e.g. biosemi128)
-
-    :param digmontage: a MNE DigMontage object constructed from
-                       electrode and landmark coordinates read
-                       from .csv file created by a MATLAB
-                       function ANT_MNE_fastscan.m using MNE
-                       function read_dig_montage
-
-    :param kind: a string specifying the new Montage object
-                 created. We expect it to be duke129_dig, which
-                 is an arbitrary name that I give the Montage
-
-    :return:
-             montage: a MNE Montage object with digitization
-                      of electrode and landmark coordinates
-    """
-    import numpy as np
-
-    # provide a kind label for the new montage
-    montage.kind = kind
-
-    # append the anatomical landmarks to the channel channel
-    montage.ch_names = digmontage.point_names + ['Nz', 'LPA', 'RPA']
-
-    # update the landmark positions
-    montage.nasion = digmontage.nasion
-    montage.lpa = digmontage.lpa
-    montage.rpa = digmontage.rpa
-
-    # update electrode and landmark positions .shape = (132, 3)
-    newpos = np.row_stack((digmontage.elp, digmontage.nasion, digmontage.lpa, digmontage.rpa))
-    montage.pos = newpos
-
-    # update the selection vector (adding 1 due to the 1 additional EOG channel on duke_129)
-    montage.selection = np.append(montage.selection, 131)
-
-    # confirm number of channels not changed
-    assert montage.pos.shape == (132, 3), 'Dimension of montage positions is changed!'
-    assert np.all(montage.selection == np.arange(132)), 'Selection index is not selecting all 132 positions!'
-
-    return montage
-
-
-def ant_mne_create_montage(csvfn, dig_filepath, new_MNEv=True):
+import os
+import os.path as op
+import csv
+import functools
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from mne.channels import make_dig_montage
+from mne.io import read_raw_eeglab, read_raw_fif
+
+
+def ant_mne_create_montage(csvfn, dig_filepath):
     """
-    This function is used to create a Montage object from
+    This function is used to create a DigMontage object from
     FastScanII acquired landmark and electrode locations. It
     expects a .csv file created using a MATLAB function
     ANT_MNE_fastscan.m that has a manual quality control of
@@ -94,102 +49,72 @@ def ant_mne_create_montage(csvfn, dig_filepath, new_MNEv=True):
     - expects a .csv file with anatomical landmark (fiducial)
     and electrode labels and coordinates.
 
-    # UPDATE: MNE v0.19+ uses a different set of APIs, this function modified to accommodate the new API
+    # UPDATE: MNE v0.19+ uses a different set of APIs, this function only supports the new API
 
     :param csvfn: file name of the .csv file
 
     :param dig_filepath: full path to the folder containing
                          the .csv file
 
-    :param new_MNEv: whether to use routine for newer MNE version
-
     :return:
-             montage: a MNE Montage object with digitization
+             montage: a MNE DigMontage object with digitization
                       of electrode and landmark coordinates
-                      if MNE v0.19+ is sued, montage is a DigMontage object
     """
-    import os.path as op
-    import numpy as np
-    from pandas import read_csv
-
     # print message
     print('Creating digitized montage using .csv file: ' + csvfn)
 
     # configure full path name of the .csv file
     fname = op.join(dig_filepath, csvfn)
 
-    # load in the .csv file with labels and XYZ values
-    df = read_csv(fname)
-
-    # create a list of labels
-    point_names = [x.strip() for x in df.labels.to_numpy()]
-
-    # create a numpy.ndarray of xyz values of electrode position points
-    xyz = df[['X', 'Y', 'Z']]
-    elp = xyz.to_numpy()
-
-    # do different things depending on the MNE version
-    if new_MNEv:
-        from mne.channels import make_dig_montage
-
-        ch_xyz_in_m = elp[3:, :] / 1000  # make_dig_montage expects coordinates to be in unit of meters
-        ch_label = point_names[3:]
-        assert len(ch_label) == ch_xyz_in_m.shape[0] == 129 and ch_xyz_in_m.shape[1] == 3, \
-            'Dimensions of labels and electrodes are incorrect!'
-
-        ch_pos = dict()
-        for x in range(len(ch_label)):
-            ch_pos[ch_label[x]] = ch_xyz_in_m[x, :]
-        nasion = elp[point_names.index('nasion'), :] / 1000
-        lpa = elp[point_names.index('lpa'), :] / 1000
-        rpa = elp[point_names.index('rpa'), :] / 1000
+    # load in the .csv file with labels and XYZ values, locating the columns by header name
+    with open(fname, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        header = [x.strip() for x in next(reader)]
+        label_col = header.index('labels')
+        xyz_cols = [header.index(x) for x in ('X', 'Y', 'Z')]
+        rows = [row for row in reader if row]
+
+    # create a list of labels and a numpy.ndarray of xyz values of electrode position points
+    point_names = []
+    elp = np.empty((len(rows), 3), dtype=np.float64)
+    for i, row in enumerate(rows):
+        point_names.append(row[label_col].strip())  # MATLAB char arrays pad labels with spaces
+        elp[i] = [float(row[c]) for c in xyz_cols]
+    point_idx = {name: i for i, name in enumerate(point_names)}
+
+    elp_m = elp / 1000  # make_dig_montage expects coordinates to be in unit of meters
+    ch_xyz_in_m = elp_m[3:, :]
+    ch_label = point_names[3:]
+    assert len(ch_label) == ch_xyz_in_m.shape[0] == 129 and ch_xyz_in_m.shape[1] == 3, \
+        'Dimensions of labels and electrodes are incorrect!'
+
+    ch_pos = dict(zip(ch_label, ch_xyz_in_m))
+    nasion = elp_m[point_idx['nasion'], :]
+    lpa = elp_m[point_idx['lpa'], :]
+    rpa = elp_m[point_idx['rpa'], :]
+
+    montage = make_dig_montage(ch_pos=ch_pos, nasion=nasion, lpa=lpa, rpa=rpa)
 
-        montage = make_dig_montage(ch_pos=ch_pos, nasion=nasion, lpa=lpa, rpa=rpa)
-
-    else:
-        from mne.channels import read_montage
-        from mne.channels import read_dig_montage
-
-        # compute the distance between right and left preauricular points in imported data
-        old_ppd = np.linalg.norm(elp[point_names.index('rpa')] - elp[point_names.index('lpa')])
-
-        # check that dimensions of labels and electrode coordinates are consistent
-        # here we expect using ANT Duke Waveguard cap with 129 electrodes
-        assert len(point_names) == elp.shape[0] == 132 and elp.shape[1] == 3, \
-            'Dimensions of labels and electrodes are incorrect!'
-
-        # create a DigMontage object
-        #   - since we are specifying fidicuals (nasion, lpa, and rpa), setting transform=True will
-        #   automatically convert the elp positions in digmontage to MNE head coordinates system.
-        #   The unit will also be transformed from 'mm' to 'm' in calling read_dig_montage
-        digmontage = read_dig_montage(elp=elp, point_names=point_names, unit='auto', transform=True)
-
-        # compute the new distance after transforming in MNE head coordinates system and rescaled to meter
-        new_ppd = np.linalg.norm(digmontage.rpa - digmontage.lpa) * 1000  # rescale to mm as in FastScanII
-
-        # check that the preauricular point distance is not altered and in correct scale
-        assert abs(new_ppd - old_ppd) < 1e-12, \
-            'Preauricular point distance is changed in creating montage!'
-
-        # create an instance of a fake Montage object
-        montage = read_montage(kind='biosemi128')
+    return montage
 
-        # convert the information from DigMontage object to Montage object
-        montage = ant_mne_dig2mont(montage, digmontage, kind='duke129_dig')
 
-    return montage
+def _fif_fname(setfn, set_filepath):
+    """
+    Full path of the _raw.fif file saved next to a .set file.
+    """
+    return op.join(set_filepath, op.splitext(setfn)[0] + '_raw.fif')
 
 
-def ant_mne_create_raw(setfn, set_filepath, csvfn, dig_filepath, overwrite=True):
+def ant_mne_create_raw(setfn, set_filepath, csvfn, dig_filepath, overwrite=True, preload=True,
+                       show_plot=False, return_fig=False):
     """
     This function is used to create a MNE Raw object by
     loading an EEGLAB .set file. The created Raw object
     will also be saved with suffix _raw.fif appended,
-    in the same directory as that of the .set file.
+    in the same directory as that of the .set file,
+    unless overwrite is None.
 
-    # UPDATE: MNE v0.19+ uses a different set of API, this function has been adjusted to accommodate
-    the newest version of MNE for the new API. It should be back-compatible for versions before
-    v0.19 such as v0.18.2, but I haven't tested this function for back-compatibility.
+    # UPDATE: MNE v0.19+ uses a different set of API, this function only supports the new API
 
     :param setfn: file name of the .set file
 
@@ -208,8 +133,30 @@ def ant_mne_create_raw(setfn, set_filepath, csvfn, dig_filepath, overwrite=True)
     :param dig_filepath: full path to the folder containing
                          the .csv file
 
-    :param overwrite: whether to overwrite existing _raw.fif
-                      file
+    :param overwrite: True rebuilds the Raw object from the
+                      .set and .csv files and overwrites any
+                      existing _raw.fif file. False loads an
+                      existing _raw.fif file as is, ignoring
+                      csvfn and show_plot, and otherwise
+                      rebuilds and saves it. None rebuilds
+                      the Raw object in memory without
+                      reading or saving any _raw.fif file
+
+    :param preload: passed on to read_raw_eeglab or
+                    read_raw_fif. True loads
+                    the data into memory; a file name keeps
+                    the data in a memory-mapped file on disk,
+                    which lowers peak memory use for long
+                    recordings
+
+    :param show_plot: whether to plot the template montage
+                      against the subject specific montage.
+                      Leave False in batch processing to
+                      skip loading matplotlib altogether
+
+    :param return_fig: whether to also return the sensor
+                       comparison figure, which is None
+                       unless show_plot is True
 
     :return:
              raw: a MNE Raw object with all data in the .cnt
@@ -219,38 +166,30 @@ def ant_mne_create_raw(setfn, set_filepath, csvfn, dig_filepath, overwrite=True)
                   with other info standard to a MNE Raw
                   object. All subsequent processing in
                   python can start with this data structure
-    """
-    import os.path as op
-    import mne
-    from mne.io import read_raw_eeglab
-    import matplotlib.pyplot as plt
-
-    # Get MNE version number
-    mne_version = mne.__version__
-    mne_version_n = [int(x) for x in mne_version.split('.')]
 
+             fig: the matplotlib Figure comparing template and
+                  subject specific montages, only returned
+                  when return_fig is True
+    """
     # configure file name of the .set file
     fname = op.join(set_filepath, setfn)
+    fif_fname = _fif_fname(setfn, set_filepath)
+    fig = None
 
-    if mne_version_n[0] < 0 and mne_version_n[1] < 19:
+    # reuse a _raw.fif file created by an earlier run
+    if overwrite is False and op.exists(fif_fname):
+        print('Loading existing _raw.fif file: ' + fif_fname)
+        raw = read_raw_fif(fif_fname, preload=preload)
+        if return_fig:
+            return raw, fig
+        return raw
 
-        # construct a montage object
-        montage = ant_mne_create_montage(csvfn, dig_filepath, new_MNEv=False)
+    # create a mne.io.Raw object of the data
+    print('Loading .set file: ' + setfn)
+    raw = read_raw_eeglab(input_fname=fname, preload=preload)
 
-        # create a mne.io.Raw object of the data with montage input
-        print('Loading .set file: ' + setfn)
-        raw = read_raw_eeglab(input_fname=fname, montage=montage, preload=True)
-
-        # save this raw object in a FIF format to set_filepath directory
-        if overwrite is not None:
-            fif_fname = op.join(set_filepath, setfn.strip('.set') + '_raw.fif')
-            raw.save(fif_fname, overwrite=overwrite)
-
-    else:
-
-        # create a mne.io.Raw object of the data
-        print('Loading .set file: ' + setfn)
-        raw = read_raw_eeglab(input_fname=fname, preload=True)
+    if show_plot:
+        import matplotlib.pyplot as plt
 
         fig = plt.figure()
         ax1 = fig.add_subplot(121)
@@ -259,18 +198,101 @@ def ant_mne_create_raw(setfn, set_filepath, csvfn, dig_filepath, overwrite=True)
         # visualize the default template electrode montage (Duke Waveguard 128+EOG)
         raw.plot_sensors(show_names=True, axes=ax1)
 
-        # construct a DigMontage object
-        montage = ant_mne_create_montage(csvfn, dig_filepath, new_MNEv=True)
+    # construct a DigMontage object
+    montage = ant_mne_create_montage(csvfn, dig_filepath)
 
-        # update the Raw object with digitization montage information
-        raw = raw.set_montage(montage)
+    # update the Raw object with digitization montage information
+    raw = raw.set_montage(montage)
 
-        # visualize the default template electrode montage (Duke Waveguard 128+EOG)
-        raw.plot_sensors(show_names=True, title='Duke Template (LEFT) vs. Subject Specific Montage (RIGHT)', axes=ax2)
+    if show_plot:
+        # visualize the subject specific electrode montage
+        raw.plot_sensors(show_names=True, title='Duke Template (LEFT) vs. Subject Specific Montage (RIGHT)',
+                         axes=ax2)
 
-        # save this raw object in a FIF format to set_filepath directory
-        if overwrite is not None:
-            fif_fname = op.join(set_filepath, setfn.strip('.set') + '_raw.fif')
-            raw.save(fif_fname, overwrite=overwrite)
+    # save this raw object in a FIF format to set_filepath directory
+    if overwrite is not None:
+        raw.save(fif_fname, fmt='single', overwrite=overwrite, split_size='2GB')
 
+    if return_fig:
+        return raw, fig
     return raw
+
+
+def _ant_mne_create_raw_worker(args, overwrite=True, tmp_dir=None):
+    """
+    Run ant_mne_create_raw for one recording in a worker process.
+    The data are backed by a temporary memory-mapped file in tmp_dir
+    (the folder of the .set file if None), and the _raw.fif file name
+    is returned instead of the Raw object so the data are not pickled
+    back to the parent process.
+    """
+    setfn, set_filepath, csvfn, dig_filepath = args
+    fif_fname = _fif_fname(setfn, set_filepath)
+    if not overwrite and op.exists(fif_fname):
+        return fif_fname
+
+    fd, mmap_fname = tempfile.mkstemp(suffix='.dat', prefix=op.splitext(setfn)[0] + '_mmap_',
+                                      dir=set_filepath if tmp_dir is None else tmp_dir)
+    os.close(fd)
+    try:
+        ant_mne_create_raw(setfn, set_filepath, csvfn, dig_filepath, overwrite=overwrite, preload=mmap_fname)
+    finally:
+        # best-effort cleanup: the memory-mapped data may still be held open (e.g. on Windows), and a
+        # failed removal must neither replace an error nor fail a recording whose _raw.fif was saved
+        try:
+            os.remove(mmap_fname)
+        except OSError:
+            pass
+
+    return fif_fname
+
+
+def ant_mne_create_raw_batch(list_of_args, n_workers=None, overwrite=True, tmp_dir=None):
+    """
+    This function is used to create _raw.fif files for many
+    recordings in parallel, one ant_mne_create_raw call per
+    recording in a separate process. Sensor plots are never
+    drawn in the workers.
+
+    On platforms that spawn new processes (Windows, macOS),
+    call this function under an if __name__ == '__main__':
+    guard in the calling script.
+
+    :param list_of_args: list of (setfn, set_filepath, csvfn,
+                         dig_filepath) tuples, see
+                         ant_mne_create_raw
+
+    :param n_workers: maximal number of worker processes,
+                      defaults to the number of CPUs
+
+    :param overwrite: True or False, whether to overwrite
+                      existing _raw.fif files. If False,
+                      recordings that already have a _raw.fif
+                      file are skipped. None is not allowed
+                      since the batch only exists to save files
+
+    :param tmp_dir: folder for the temporary memory-mapped
+                    files holding each recording while it
+                    is converted. Defaults to the folder of
+                    each .set file; avoid a tmpfs or small
+                    system temp partition, since up to
+                    n_workers whole recordings sit there
+                    at once. Files are named after their
+                    recording (<setfn>_mmap_*.dat), so any
+                    left behind by a killed worker can be
+                    found and deleted
+
+    :return:
+             fif_fnames: list of full paths to the saved
+                         _raw.fif files, in the same order as
+                         list_of_args
+    """
+    if overwrite is None:
+        raise ValueError('overwrite=None would not save any _raw.fif file, use True or False.')
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        fif_fnames = list(executor.map(functools.partial(_ant_mne_create_raw_worker, overwrite=overwrite,
+                                                         tmp_dir=tmp_dir),
+                                       list_of_args))
+
+    return fif_fnames